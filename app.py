@@ -1,11 +1,21 @@
+from __future__ import annotations
+
+import os
 import re
 import asyncio
-from typing import List, Optional, Dict, Any
+import multiprocessing
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Dict, Any, Iterable, Callable, Awaitable
 
 import orjson
-import httpx
-from fastapi import FastAPI, Query, Body, HTTPException, Request
+import aiohttp
+import xxhash
+from cachebox import TTLCache, LRUCache
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 from slowapi import Limiter
@@ -14,20 +24,68 @@ from slowapi.errors import RateLimitExceeded
 
 from googlesearch import search as gsearch
 import trafilatura
-from bs4 import BeautifulSoup
+from lxml import etree
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
 
 # Settings
 class Settings(BaseSettings):
     TIMEOUT: int = 15
+    CONNECT_TIMEOUT: int = 5
+    SNIPPET_DEADLINE: float = 5
     MAX_RESULTS: int = 20
     RATE_LIMIT: str = "60/minute"
+    RATE_LIMIT_STRATEGY: str = "sliding-window-counter"
+    RATE_LIMIT_STORAGE_URI: str = "memory://"
+    CACHE_TTL: int = 600
+    CACHE_MAXSIZE: int = 1024
+    CACHE_SWEEP_INTERVAL: int = 60
+    EXTRACTION_CACHE_MAXSIZE: int = 1024
+    EXTRACT_WORKERS: Optional[int] = None
+    WEB_CONCURRENCY: int = 1
+    SCRAPE_WORKERS: int = 8
+    HTTP_MAX_CONNECTIONS: int = 200
+    HTTP_LIMIT_PER_HOST: int = 10
+    DNS_CACHE_TTL: int = 300
+    MAX_HTML_BYTES: int = 2_000_000
 
 settings = Settings()
+cache = TTLCache(settings.CACHE_MAXSIZE, settings.CACHE_TTL, sweep_interval=settings.CACHE_SWEEP_INTERVAL)
+extraction_cache = LRUCache(settings.EXTRACTION_CACHE_MAXSIZE)
 
 # App & Middleware
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(title="LLM Web Search API", version="1.0.8-autocaption-fix")
+limiter = Limiter(key_func=get_remote_address, strategy=settings.RATE_LIMIT_STRATEGY, storage_uri=settings.RATE_LIMIT_STORAGE_URI)
+
+# Endpoints return this directly for large payloads: FastAPI passes Response objects through untouched,
+# skipping the pure-Python jsonable_encoder walk it otherwise runs before serializing a returned dict
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One long-lived session so keep-alive connections and DNS lookups are reused across requests
+    app.state.http = aiohttp.ClientSession(
+        headers=HEADERS,
+        timeout=HTTP_TIMEOUTS,
+        # aiohttp rejects header lines over 8190 bytes; large CSP/Link/Set-Cookie headers are common on news and CDN sites
+        max_line_size=32768,
+        max_field_size=32768,
+        connector=aiohttp.TCPConnector(
+            limit=settings.HTTP_MAX_CONNECTIONS,
+            limit_per_host=settings.HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=settings.DNS_CACHE_TTL,
+            keepalive_timeout=60,
+        ),
+    )
+    app.state.cpu_pool = make_cpu_pool()
+    # Blocking scraper calls get their own bounded pool, which also caps concurrent requests to Google
+    app.state.scrape_pool = ThreadPoolExecutor(max_workers=settings.SCRAPE_WORKERS, thread_name_prefix="scrape")
+    yield
+    await app.state.http.close()
+    app.state.cpu_pool.shutdown(cancel_futures=True)
+    app.state.scrape_pool.shutdown(cancel_futures=True)
+
+app = FastAPI(title="LLM Web Search API", version="1.0.8-autocaption-fix", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.state.limiter = limiter
 
 app.add_middleware(
@@ -40,7 +98,7 @@ app.add_middleware(
 
 @app.exception_handler(RateLimitExceeded)
 def ratelimit_handler(request: Request, exc: RateLimitExceeded):
-    return HTTPException(status_code=429, detail="Rate limit exceeded.")
+    return ORJSONResponse(status_code=429, content={"detail": "Rate limit exceeded."})
 
 # Pydantic Models
 class SearchParams(BaseModel):
@@ -56,26 +114,200 @@ class YTParams(BaseModel):
     languages: List[str] = Field(default_factory=lambda: ["en", "en-US"])
 
 # Helper Functions
+_inflight: Dict[Any, asyncio.Future] = {}
+async def single_flight(key: Any, make: Callable[[], Awaitable]):
+    # Concurrent cache misses for the same key share one upstream call; shield() keeps a
+    # disconnecting caller from cancelling the work the others are waiting on
+    if (task := _inflight.get(key)) is None:
+        task = _inflight[key] = asyncio.ensure_future(make())
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+# Dead hosts fail on the short socket-connect timeout instead of holding a fan-out slot for the full TIMEOUT;
+# aiohttp's `connect` would also count the wait for a free pooled connection, so it is left unset
+HTTP_TIMEOUTS = aiohttp.ClientTimeout(total=settings.TIMEOUT, sock_connect=settings.CONNECT_TIMEOUT)
 HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"}
-async def fetch_html(client: httpx.AsyncClient, url: str):
+async def fetch_html(session: aiohttp.ClientSession, url: str):
+    # Streams the body so at most MAX_HTML_BYTES are held per page
     try:
-        r = await client.get(url, headers=HEADERS, timeout=settings.TIMEOUT, follow_redirects=True)
-        r.raise_for_status()
-        return r.text
+        async with session.get(url) as r:
+            r.raise_for_status()
+            buf = bytearray()
+            async for chunk in r.content.iter_any():
+                buf += chunk
+                if len(buf) >= settings.MAX_HTML_BYTES: break
+            return buf[:settings.MAX_HTML_BYTES].decode(r.charset or "utf-8", errors="replace")
     except Exception: return None
 
-async def get_snippet(html: str):
-    soup = BeautifulSoup(html, "lxml")
-    title = soup.title.get_text(strip=True) if soup.title else "No Title Found"
-    desc = ""
-    if m := soup.find("meta", {"name": "description"}): desc = m.get("content", "").strip()
-    return {"title": title, "description": desc}
+def clean_text(t: Optional[str]):
+    # str.split() with no separator splits on runs of Unicode whitespace, same as \s+, without the regex engine
+    return " ".join(t.split()) if t else ""
+
+def make_snippet(title: Optional[str], metas: Dict[str, str]):
+    # Fall back to the OpenGraph description, which many sites set instead of (or better than) the plain one
+    desc = clean_text(metas.get("description")) or clean_text(metas.get("og:description"))
+    return {"title": clean_text(title) or "No Title Found", "description": desc}
+
+async def read_snippet(session: aiohttp.ClientSession, url: str):
+    # Feeds the streamed body to an incremental parser and stops at the end of <head> or the start of <body>;
+    # libxml2 only closes an implied <head> at EOF, so head-less HTML5 pages stop on the body start instead
+    try:
+        async with session.get(url) as r:
+            r.raise_for_status()
+            parser = etree.HTMLPullParser(events=("start", "end"), tag=("title", "meta", "head", "body"), encoding=r.charset or "utf-8")
+            title, metas, read = None, {}, 0
+            async for chunk in r.content.iter_any():
+                parser.feed(chunk)
+                read += len(chunk)
+                for event, el in parser.read_events():
+                    if el.tag == "body" or (event == "end" and el.tag == "head"): return make_snippet(title, metas)
+                    if event == "start": continue
+                    if el.tag == "title": title = title or el.text
+                    elif name := (el.get("name") or el.get("property") or "").lower(): metas.setdefault(name, el.get("content"))
+                if read >= settings.MAX_HTML_BYTES: break
+            return make_snippet(title, metas) if read else None
+    except Exception: return None
+
+async def load_snippet(session: aiohttp.ClientSession, url: str, key: tuple):
+    if not (snippet := await read_snippet(session, url)): return {}
+    cache[key] = snippet
+    return snippet
+
+async def fetch_snippet(session: aiohttp.ClientSession, url: str):
+    key = ("/snippet", url)
+    if (cached := cache.get(key)) is not None: return cached
+    return await single_flight(key, lambda: load_snippet(session, url, key))
+
+async def gather_snippets(session: aiohttp.ClientSession, urls: List[str], timeout: float):
+    # Bounds the whole fan-out well below the per-fetch TIMEOUT: stragglers past the deadline come back as {}.
+    # Cancelling a waiter leaves the shared single_flight task running, so its snippet still lands in the cache
+    tasks = [asyncio.ensure_future(fetch_snippet(session, u)) for u in urls]
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for t in pending: t.cancel()
+    return [{} if t in pending or t.exception() else t.result() for t in tasks]
+
+def canon_url(url: str):
+    # Plain str.partition splitting; a full urlparse is not needed just to build a dedupe key
+    scheme, _, rest = url.partition("://")
+    rest, _, query = rest.partition("#")[0].partition("?")
+    host, slash, path = rest.partition("/")
+    return f"{scheme.lower()}://{host.lower()}{slash}{path}".rstrip("/") + (f"?{query}" if query else "")
+
+def dedupe_urls(urls: Iterable[str], limit: Optional[int] = None):
+    # Keep the first URL seen for each canonical form; each URL is parsed exactly once.
+    # Stops consuming `urls` as soon as `limit` unique URLs have been collected.
+    seen = {}
+    for u in urls:
+        if u: seen.setdefault(canon_url(u), u)
+        if limit and len(seen) >= limit: break
+    return list(seen.values())
+
+def google_urls(q: str, num: int):
+    # gsearch is lazy, so asking for MAX_RESULTS only costs extra requests when duplicates eat into `num`
+    return dedupe_urls(gsearch(q, num_results=settings.MAX_RESULTS, lang='en'), num)
+
+async def load_urls(pool: ThreadPoolExecutor, q: str, num: int, key: tuple):
+    urls = await asyncio.get_running_loop().run_in_executor(pool, google_urls, q, num)
+    if urls: cache[key] = (urls, len(urls) < num)
+    return urls
+
+def fallback_extract(html: str, url: str):
+    # trafilatura gives up on short or unusually structured pages; resiliparse's C++ extractor
+    # still recovers their main text quickly
+    from resiliparse.parse.html import HTMLTree
+    from resiliparse.extract.html2text import extract_plain_text
+    tree = HTMLTree.parse(html)
+    if not (text := extract_plain_text(tree, main_content=True, alt_texts=False)): return None
+    return orjson.dumps({"text": text, "title": tree.title or None, "url": url})
 
+def run_extractors(html: str, url: str):
+    # Pure CPU work (lxml parsing, boilerplate pruning); runs in the extraction process pool
+    data_str = trafilatura.extract(html, url=url, output_format='json')
+    return data_str.encode() if data_str else (fallback_extract(html, url) or b"")
+
+def make_cpu_pool():
+    # Extraction is CPU-bound and mostly holds the GIL, so it runs in worker processes off the event loop.
+    # Workers start from a forkserver rather than forking this process, which by then runs the cache sweeper and executor threads;
+    # the forkserver imports trafilatura once, so every worker forked from it starts warm and shares those pages
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["trafilatura"])
+    # Unless set, the cores are split between the uvicorn workers, each of which owns a pool
+    workers = settings.EXTRACT_WORKERS or max(1, (os.cpu_count() or 1) // settings.WEB_CONCURRENCY)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+
+async def run_extract(app: FastAPI, html: str, url: str):
+    loop, pool = asyncio.get_running_loop(), app.state.cpu_pool
+    try: return await loop.run_in_executor(pool, run_extractors, html, url)
+    except BrokenProcessPool:
+        # A dead worker (OOM kill, crash in lxml/resiliparse) breaks the executor for good: replace it once and retry
+        if app.state.cpu_pool is pool:
+            app.state.cpu_pool = make_cpu_pool()
+            pool.shutdown(wait=False)
+        return await loop.run_in_executor(app.state.cpu_pool, run_extractors, html, url)
+
+async def extract_blob(app: FastAPI, html: str, url: str):
+    # Content-addressed: the same page bytes at the same URL always extract to the same JSON,
+    # so a refetch of an unchanged page skips trafilatura even after the /extract entry expired
+    key = (url, xxhash.xxh3_64_intdigest(html.encode()))
+    if (blob := extraction_cache.get(key)) is not None: return blob
+    extraction_cache[key] = blob = await run_extract(app, html, url)
+    return blob
+
+async def load_extract(app: FastAPI, url: str, key: tuple):
+    html = await fetch_html(app.state.http, url)
+    if not html: raise HTTPException(status_code=422, detail="Could not fetch content from URL.")
+    if not (blob := await extract_blob(app, html, url)): return None
+    cache[key] = blob
+    return blob
+
+_YT_ID_RE = re.compile(r"(?:v=|/(?:embed|v|e)/|youtu\.be/)([\w-]{11})")
 def _yt_id_from_url(url_or_id: str):
-    if m := re.search(r"(?:v=|/embed/|youtu\.be/|/v/|/e/|watch\?v=|\?v=|\&v=)([^#\&\?]{11})", url_or_id):
+    if m := _YT_ID_RE.search(url_or_id):
         return m.group(1)
     return url_or_id
 
+def _list_transcripts(vid: str):
+    # The available-transcripts listing is one YouTube round-trip per video; reuse it across language requests
+    key = ("/yt:transcripts", vid)
+    if (cached := cache.get(key)) is not None: return cached
+    cache[key] = transcript_list = YouTubeTranscriptApi.list_transcripts(vid)
+    return transcript_list
+
+def _fetch_subtitles(vid: str, languages: List[str]):
+    transcript_list = _list_transcripts(vid)
+
+    transcript = None
+    is_generated = False
+    try:
+        # First, try to find a manually created transcript
+        transcript = transcript_list.find_transcript(languages)
+    except NoTranscriptFound:
+        # If that fails, try to find an auto-generated transcript
+        try:
+            transcript = transcript_list.find_generated_transcript(languages)
+            is_generated = True
+        except NoTranscriptFound:
+            # If both fail, then there are no subtitles
+            raise NoTranscriptFound("No manual or auto-generated subtitles found for the given languages.")
+
+    items = transcript.fetch()
+    # One newline replace over the joined string instead of one per segment; empty segments are skipped
+    full_text = " ".join(filter(None, (item.get("text") for item in items))).replace('\n', ' ')
+
+    return {
+        "video_id": vid,
+        "language_code": transcript.language_code,
+        "is_generated": is_generated,
+        "text": full_text,
+        "segments": items
+    }
+
+async def load_subtitles(pool: ThreadPoolExecutor, vid: str, languages: List[str], key: tuple):
+    # youtube-transcript-api is blocking, so run it on the scrape pool off the event loop
+    data = await asyncio.get_running_loop().run_in_executor(pool, _fetch_subtitles, vid, languages)
+    cache[key] = blob = orjson.dumps(data)
+    return blob
+
 # API Endpoints
 @app.get("/")
 def root(): return {"message": "API is running. Visit /docs for documentation."}
@@ -83,18 +315,23 @@ def root(): return {"message": "API is running. Visit /docs for documentation."}
 @app.post("/search")
 @limiter.limit(settings.RATE_LIMIT)
 async def api_search(request: Request, params: SearchParams):
+    # URL lists are cached per query, not per `num`, so any smaller `num` is served as a slice
+    key = ("/search:urls", params.q)
     try:
-        loop = asyncio.get_event_loop()
-        urls = await loop.run_in_executor(None, lambda: list(gsearch(params.q, num_results=params.num, lang='en')))
+        cached = cache.get(key)
+        if cached is not None and (len(cached[0]) >= params.num or cached[1]):
+            urls = cached[0][:params.num]
+        else:
+            pool = request.app.state.scrape_pool
+            urls = await single_flight(key + (params.num,), lambda: load_urls(pool, params.q, params.num, key))
         if not urls: return {"query": params.q, "count": 0, "results": [], "warning": "No results found or request was blocked by Google."}
-        results = [{"url": u} for u in urls]
         if params.fetch_snippets:
-            async with httpx.AsyncClient() as client:
-                tasks = [fetch_html(client, res["url"]) for res in results]
-                html_contents = await asyncio.gather(*tasks)
-                for i, html in enumerate(html_contents):
-                    if html: results[i].update(await get_snippet(html))
-        return {"query": params.q, "count": len(results), "results": results}
+            session = request.app.state.http
+            snippets = await gather_snippets(session, urls, settings.SNIPPET_DEADLINE)
+            results = [{"url": u, **snippet} for u, snippet in zip(urls, snippets)]
+        else:
+            results = [{"url": u} for u in urls]
+        return ORJSONResponse({"query": params.q, "count": len(results), "results": results})
     except Exception as e:
         print(f"ERROR in /search: {e}")
         raise HTTPException(status_code=503, detail=f"Failed to fetch search results. Server might be blocked. Error: {str(e)}")
@@ -102,46 +339,28 @@ async def api_search(request: Request, params: SearchParams):
 @app.post("/extract")
 @limiter.limit(settings.RATE_LIMIT)
 async def api_extract(request: Request, params: ExtractParams):
+    # Cached as serialized JSON so a hit is returned without re-encoding
+    key = ("/extract", params.url)
+    if (cached := cache.get(key)) is not None: return Response(content=cached, media_type="application/json")
     try:
-        async with httpx.AsyncClient() as client: html = await fetch_html(client, params.url)
-        if not html: raise HTTPException(status_code=422, detail="Could not fetch content from URL.")
-        data_str = trafilatura.extract(html, url=params.url, output_format='json')
-        return orjson.loads(data_str) if data_str else {"text": "Could not extract main content.", "url": params.url}
+        blob = await single_flight(key, lambda: load_extract(request.app, params.url, key))
+        if not blob: return {"text": "Could not extract main content.", "url": params.url}
+        return Response(content=blob, media_type="application/json")
     except Exception as e:
         print(f"ERROR in /extract: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to extract content. Error: {str(e)}")
 
 @app.post("/yt/subtitles")
 @limiter.limit(settings.RATE_LIMIT)
-def yt_subtitles(request: Request, p: YTParams):
+async def yt_subtitles(request: Request, p: YTParams):
+    # Published transcripts don't change, so whole responses are cached (serialized) per video and language list
+    vid = _yt_id_from_url(p.video_id)
+    key = ("/yt/subtitles", vid, tuple(p.languages))
+    if (cached := cache.get(key)) is not None: return Response(content=cached, media_type="application/json")
     try:
-        vid = _yt_id_from_url(p.video_id)
-        transcript_list = YouTubeTranscriptApi.list_transcripts(vid)
-        
-        transcript = None
-        is_generated = False
-        try:
-            # First, try to find a manually created transcript
-            transcript = transcript_list.find_transcript(p.languages)
-        except NoTranscriptFound:
-            # If that fails, try to find an auto-generated transcript
-            try:
-                transcript = transcript_list.find_generated_transcript(p.languages)
-                is_generated = True
-            except NoTranscriptFound:
-                # If both fail, then there are no subtitles
-                raise NoTranscriptFound("No manual or auto-generated subtitles found for the given languages.")
-        
-        items = transcript.fetch()
-        full_text = " ".join([item["text"].replace('\n', ' ') for item in items])
-        
-        return {
-            "video_id": vid, 
-            "language_code": transcript.language_code, 
-            "is_generated": is_generated,
-            "text": full_text, 
-            "segments": items
-        }
+        pool = request.app.state.scrape_pool
+        blob = await single_flight(key, lambda: load_subtitles(pool, vid, p.languages, key))
+        return Response(content=blob, media_type="application/json")
     except (TranscriptsDisabled, NoTranscriptFound) as e:
         raise HTTPException(status_code=404, detail=f"Could not find subtitles. Reason: {str(e)}")
     except Exception as e: